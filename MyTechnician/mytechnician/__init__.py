@@ -9,6 +9,7 @@ import time
 import sys
 import bz2
 import statistics
+import multiprocessing
 from collections import defaultdict
 
 pico_in  = mido.get_input_names()[1]           # NOQA -- I like this indentation better
@@ -17,6 +18,7 @@ c=cstruct()
 with open('../RaspberryPiPico/My_MIDI_constants.h') as f:
   c.load(f.read())
 
+defined = c
 midi_strings = c.consts
 
 midi_values = {}
@@ -29,6 +31,54 @@ for k in midi_strings.keys():
 print(midi_strings)
 print(midi_values)
 
+FIRMWARE_REGULATION = dict(let_off=2700, strike=2600, drop=4080)     # as in the Pico init code
+SCOPE_HEADER = 4                                                   # count, LET_OFF, STRIKE, DROP
+
+
+def _scope_view(shm, size):
+    import numpy as np
+    ring = np.ndarray((SCOPE_HEADER + 2 * size,), dtype=np.float64, buffer=shm.buf)
+    return ring[:SCOPE_HEADER], ring[SCOPE_HEADER:SCOPE_HEADER + size], ring[SCOPE_HEADER + size:]
+
+
+def _scope(shm_name, size, note, span):
+    # runs in its own process, so drawing never slows down the receiving thread
+    import matplotlib.pyplot as plt
+    from matplotlib.animation import FuncAnimation
+    import numpy as np
+    from multiprocessing import shared_memory          # python 3.8 or newer, only for the scope
+    shm = shared_memory.SharedMemory(name=shm_name)
+    header, times, values = _scope_view(shm, size)
+
+    fig, ax = plt.subplots()
+    trace, = ax.plot([], [], label="MIDI note " + str(note))
+    lines = [ax.axhline(y=header[1], linestyle='-', color="green", label="let off", animated=True),
+             ax.axhline(y=header[2], linestyle='-', color="yellow", label="strike", animated=True),
+             ax.axhline(y=header[3], linestyle='-', color="red", label="drop", animated=True)]
+    trace.set_animated(True)
+    ax.set_xlim(-span, 0)
+    ax.set_ylim(0, 4096)
+    ax.set_xlabel('time (ms)')
+    ax.set_ylabel('Raw ADC value')
+    ax.legend(loc="lower left")
+
+    def update(frame):
+        count = int(header[0])
+        n = min(count, size)
+        idx = np.arange(count - n, count) % size
+        t = times[idx]
+        y = values[idx]
+        if n > 0:
+            t = (t - t[-1]) / 1000                                  # ms, latest sample at 0
+        keep = t > -span
+        trace.set_data(t[keep], y[keep])
+        for (line, level) in zip(lines, header[1:]):
+            line.set_ydata([level, level])
+        return [trace] + lines
+
+    anim = FuncAnimation(fig, update, interval=30, blit=True, cache_frame_data=False)  # NOQA must keep a reference
+    plt.show()
+
 
 class mt:
     def _previous_not_NA(self, mylist):
@@ -186,6 +236,14 @@ class mt:
         self.must_stop = True
         self.mid = None
         self.track = None
+        self.regulation = {}
+        self.scope_note = None
+        self.scope_time = 0
+        self.scope_wraps = 0
+        self.scope_shm = None
+        self.scope_ring = None
+        self.scope_proc = None
+        self.scope_lock = threading.Lock()
 
     def _print_above(self, stuff):
         try:
@@ -207,6 +265,8 @@ class mt:
             self._print_above(options[i])
             for msg in inport:
                 self.track.append(msg)
+                if self.scope_shm is not None:
+                    self._scope_write(msg)
                 curr_time = time.time()
                 if (curr_time - last_time > .25):
                     i = (i+1) % len(options)
@@ -216,6 +276,64 @@ class mt:
                     break
         print("Capture stopped")
 
+    def _scope_write(self, msg):
+        if msg.type != 'sysex' or len(msg.data) < 4 or msg.data[0] != defined.MIDI_VENDOR:
+            return
+        with self.scope_lock:
+            if self.scope_ring is None:
+                return
+            if msg.data[1] == defined.MIDI_RTC:
+                curr_time = msg.data[2] * 128 + msg.data[3] + self.scope_wraps
+                if curr_time < self.scope_time:
+                    self.scope_wraps += 16384
+                    curr_time += 16384                                 # us
+                self.scope_time = curr_time
+            elif msg.data[1] <= defined.MIDI_MAX_ADC_VALUE and msg.data[3] == self.scope_note:
+                header, times, values = self.scope_ring
+                count = int(header[0])
+                times[count % len(times)] = self.scope_time
+                values[count % len(values)] = msg.data[1] * 128 + msg.data[2]
+                header[0] = count + 1                                  # publish only once the sample is written
+
+    def _scope_regulation(self, header, note):
+        r = self.regulation.get(note, FIRMWARE_REGULATION)
+        header[1:] = (r['let_off'], r['strike'], r['drop'])
+
+    def scope(self, note, span=500, size=65536):
+        import numpy as np
+        from multiprocessing import shared_memory      # python 3.8 or newer, only for the scope
+        self.stop_scope()
+        shm = shared_memory.SharedMemory(create=True, size=(SCOPE_HEADER + 2 * size) * np.dtype(np.float64).itemsize)
+        ring = _scope_view(shm, size)
+        ring[0][0] = 0
+        self._scope_regulation(ring[0], note)
+        proc = multiprocessing.Process(target=_scope, args=(shm.name, size, note, span), daemon=True)
+        with self.scope_lock:                          # the capture thread sees everything ready, or nothing
+            self.scope_time = 0
+            self.scope_wraps = 0
+            self.scope_note = note
+            self.scope_proc = proc
+            self.scope_ring = ring
+            self.scope_shm = shm
+        proc.start()
+        if self.must_stop:
+            print("Scope open but not capturing")
+            print("Run `mt.capture()` and `mt.adc_dump(note)` to see the trace.")
+        print("Run `mt.stop_scope()` to close the scope.")
+
+    def stop_scope(self):
+        if self.scope_shm is None:
+            return
+        shm = self.scope_shm
+        with self.scope_lock:                                          # stop the capture thread writing first
+            self.scope_shm = None
+            self.scope_ring = None
+        if self.scope_proc.is_alive():
+            self.scope_proc.terminate()
+        self.scope_proc.join()
+        shm.close()
+        shm.unlink()
+
     def abort_capture(self):
         self.must_stop = True
         print("Waiting for last packet to quit")
@@ -266,12 +384,12 @@ class mt:
             raise ValueError("Let off, Strike and Drop must be integers")
 
     def _validate_float(self, a):
-        if a < 0 or a > 255:
-            raise ValueError("Velocities must be 0-255")
+        if a < 0 or a >= 128:                  # the integer part is sent as a 7 bit MIDI data byte
+            raise ValueError("Velocities must be 0-127.99")
 
     def _int_regulation_with(self, a, verbose):
-        first = int(a / 127)
-        second = a % 127
+        first = int(a) >> 7                    # the picos decode (first << 7) + second
+        second = int(a) & 0x7F
         self.outport.send(Message('sysex', data=(
             defined.MIDI_VENDOR,
             defined.MIDI_CONTINUE_REGULATION,
@@ -318,3 +436,161 @@ class mt:
         self._float_regulation_with(vel_const, verbose)
         self._float_regulation_with(vel_slope, verbose)
         self._int_regulation_with(let_off, verbose)             # dummy to close the regulation
+        self.regulation[note] = dict(let_off=let_off, strike=strike, drop=drop,
+                                     vel_const=vel_const, vel_slope=vel_slope)
+        with self.scope_lock:
+            if self.scope_ring is not None and note == self.scope_note:
+                self._scope_regulation(self.scope_ring[0], note)
+
+    def regulate_all(self, table, verbose=False):
+        for note in table:                     # all or nothing, do not leave the keyboard half regulated
+            for key in ('let_off', 'strike', 'drop'):
+                self._validate_integer(table[note][key])
+            self._validate_float(table[note]['vel_const'])
+            self._validate_float(table[note]['vel_slope'])
+        for note in sorted(table):
+            self.regulate(note, verbose=verbose, **table[note])
+
+    def _read_adc_samples(self, filename):
+        import numpy as np
+        rtc_time = None
+        notes, times, values = [], [], []
+        for msg in MidiFile(file=bz2.open(filename, 'rb')):   # no play(), we do not need to wait in real time
+            if msg.type != 'sysex' or len(msg.data) < 4 or msg.data[0] != defined.MIDI_VENDOR:
+                continue
+            if msg.data[1] == defined.MIDI_RTC:
+                rtc_time = msg.data[2] * 128 + msg.data[3]
+            elif msg.data[1] <= defined.MIDI_MAX_ADC_VALUE and rtc_time is not None:
+                notes.append(msg.data[3])
+                times.append(rtc_time)
+                values.append(msg.data[1] * 128 + msg.data[2])
+
+        notes = np.array(notes, dtype=np.int64)
+        times = np.array(times, dtype=np.float64)
+        values = np.array(values, dtype=np.float64)
+        # unwrap the 14 bit RTC time, as done in parse_stats()
+        wraps = np.concatenate(([0], np.cumsum(np.diff(times) < 0)))
+        times = times + wraps * 16384                                    # us
+        order = np.argsort(notes, kind='stable')                         # group by note, keep time order
+        return notes[order], times[order], values[order]
+
+    def _thresholds(self, values, let_off_frac, strike_frac, drop_frac):
+        import numpy as np
+        rest = np.median(values)
+        half = (rest + values.min()) / 2
+        below = values < half
+        starts = np.flatnonzero(below & ~np.concatenate(([False], below[:-1])))
+        if len(starts) == 0:
+            return None
+        # the softest strike is the one getting less close: STRIKE must still be crossed by it
+        floor = np.minimum.reduceat(np.where(below, values, np.inf), starts).max()
+        strike_value = floor + strike_frac * (rest - floor)
+        let_off_value = strike_value + let_off_frac * (rest - strike_value)
+        drop_value = let_off_value + drop_frac * (rest - let_off_value)
+        return int(let_off_value), int(strike_value), int(drop_value)
+
+    # Strikes of each note (dumped with `adc_dump(note)` while capturing) should go from pp to ff, in any order:
+    # by rank, the fastest fly time is mapped to vel_max and the slowest to vel_min. STRIKE, LET_OFF and DROP are
+    # placed at the given fractions between the closest position of the softest strike and the rest position.
+    # VEL_CONST and VEL_SLOPE are the least squares fit of velocity = VEL_CONST - VEL_SLOPE * log10(fly time in ms),
+    # with the fly time in whole ms, at least 1, as the picos measure it with board_millis().
+    # Returns {note: {let_off, strike, drop, vel_const, vel_slope}} ready for `mt.regulate_all(table)`
+    def calibrate(self, filename, vel_min=1, vel_max=127,
+                  let_off_frac=0.25, strike_frac=0.1, drop_frac=0.9, verbose=True):
+        import numpy as np
+        notes, times, values = self._read_adc_samples(filename)
+        if len(notes) == 0:
+            raise ValueError("No ADC dump packets in " + filename)
+
+        all_notes, first = np.unique(notes, return_index=True)
+        thresholds = {}
+        for (note, begin, end) in zip(all_notes, first, np.append(first[1:], len(notes))):
+            t = self._thresholds(values[begin:end], let_off_frac, strike_frac, drop_frac)
+            if t is None:
+                print("Warning, no strikes for note", note, file=sys.stderr)
+                continue
+            thresholds[int(note)] = t
+        let_off_of = np.full(128, -1.0)
+        strike_of = np.full(128, -1.0)
+        drop_of = np.full(128, np.inf)
+        period_of = np.zeros(128)
+        for (note, begin, end) in zip(all_notes, first, np.append(first[1:], len(notes))):
+            if note in thresholds:
+                let_off_of[note], strike_of[note], drop_of[note] = thresholds[note]
+                steps = np.diff(times[begin:end])
+                period_of[note] = np.median(steps[steps > 0]) if np.any(steps > 0) else 0
+
+        # fly times of all notes at once, with the same IDLE -> FLY -> SOUND rules of parse_distance() in the picos:
+        # once above DROP a note is IDLE, the first sample below LET_OFF starts the flight and the first following
+        # sample below STRIKE ends it, unless the note goes above DROP again before that
+        new_note = np.concatenate(([True], notes[1:] != notes[:-1]))
+        idle = np.cumsum(new_note | (values > drop_of[notes]))            # a new id every time the note is IDLE
+        below_let_off = np.flatnonzero(values < let_off_of[notes])
+        fly_start = below_let_off[np.diff(idle[below_let_off], prepend=0) != 0]
+        strike_index = np.flatnonzero(values < strike_of[notes])
+        hit = np.searchsorted(strike_index, fly_start, side='right')        # strictly after the start, as in the picos
+        hit = strike_index[np.minimum(hit, len(strike_index) - 1)] if len(strike_index) > 0 else fly_start
+        good = (hit > fly_start) & (idle[hit] == idle[fly_start])
+        fly_note = notes[fly_start[good]]
+        fly_time = times[hit[good]] - times[fly_start[good]]
+        # a lost RTC packet gives two samples with the same time: the flight was shorter than a sample period
+        fly_time = np.maximum(fly_time, period_of[fly_note])
+        # the picos time the flight with the integer difference of board_millis(), and log10f(0) would be -inf
+        fly_ms = np.maximum(np.round(fly_time / 1000), 1)
+
+        # target velocities by rank within each note, fastest is loudest
+        order = np.lexsort((fly_time, fly_note))
+        fly_note = fly_note[order]
+        x = np.log10(fly_ms[order])
+        n = np.bincount(fly_note, minlength=128)
+        first = np.concatenate(([0], np.cumsum(n)[:-1]))
+        rank = np.arange(len(fly_note)) - first[fly_note]
+        y = vel_max - (vel_max - vel_min) * rank / np.maximum(n[fly_note] - 1, 1)
+
+        # batched least squares of y = VEL_CONST - VEL_SLOPE * x for every note, with both of them in the
+        # 0-127.99 range which can be sent to the picos: when the best fit is outside of it, the best bounded
+        # fit has one of them on the boundary and the other one fitted for that value
+        top = 127.99
+        sx = np.bincount(fly_note, x, minlength=128)
+        sy = np.bincount(fly_note, y, minlength=128)
+        sxx = np.bincount(fly_note, x * x, minlength=128)
+        sxy = np.bincount(fly_note, x * y, minlength=128)
+        syy = np.bincount(fly_note, y * y, minlength=128)
+        det = n * sxx - sx * sx
+        with np.errstate(divide='ignore', invalid='ignore'):
+            free_slope = -(n * sxy - sx * sy) / det
+            candidates = [(free_slope, (sy + free_slope * sx) / n)]
+            for slope in (0, top):
+                candidates.append((np.full(128, slope), (sy + slope * sx) / n))
+            for const in (0, top):
+                candidates.append(((const * sx - sxy) / sxx, np.full(128, const)))
+        best = np.full(128, np.inf)
+        const = np.zeros(128)
+        slope = np.zeros(128)
+        for (s, c) in candidates:
+            s = np.clip(np.nan_to_num(s), 0, top)
+            c = np.clip(np.nan_to_num(c), 0, top)
+            error = syy + n * c * c + s * s * sxx - 2 * c * sy + 2 * s * sxy - 2 * c * s * sx
+            better = error < best
+            best = np.where(better, error, best)
+            const = np.where(better, c, const)
+            slope = np.where(better, s, slope)
+
+        table = {}
+        for note in sorted(thresholds):
+            if n[note] < 2:
+                print("Warning, not enough strikes for note", note, "(", n[note], ")", file=sys.stderr)
+                continue
+            if det[note] <= 0:
+                print("Warning, the picos would time all strikes of note", note, "the same, skipping it", file=sys.stderr)
+                continue
+            vel_const = float(np.floor(const[note] * 100) / 100)           # sent as integer and hundredths
+            vel_slope = float(np.floor(slope[note] * 100) / 100)
+            if const[note] in (0, top) or slope[note] in (0, top):
+                print("Warning, note", note, "needs a velocity curve outside of what the picos accept, clipped", file=sys.stderr)
+            table[note] = dict(zip(('let_off', 'strike', 'drop'), thresholds[note]))
+            table[note]['vel_const'] = vel_const
+            table[note]['vel_slope'] = vel_slope
+            if verbose:
+                print("Note", note, table[note], "from", n[note], "strikes")
+        return table
@@ -10,6 +10,7 @@ action.add_argument("-d", "--dump", help="Dump the content of FILENAME on the te
 action.add_argument("-p", "--plot", help="Plot the content of FILENAME with matplotlib", action="store_true")
 action.add_argument("-s", "--stat", help="Print summary statistics about FILENAME", action="store_true")
 action.add_argument("-a", "--analysis", help="Plot analysis for MIDI velocity from ADC dump", action="store_true")
+action.add_argument("-c", "--calibrate", help="Compute a regulation table from graded strikes in FILENAME", action="store_true")
 parser.add_argument("--ignore-midi-time", help="Use the ADC values sequentially, disregarding MIDI time", action="store_true")
 parser.add_argument("-q", "--quiet", help="Do not report housekeeping messages", action="store_true")
 args = parser.parse_args()
@@ -86,5 +87,7 @@ elif args.plot:
     plot()
 elif args.dump:
     dump()
+elif args.calibrate:
+    mt.calibrate(args.filename)
 else:
     print("Nothing to do yet")
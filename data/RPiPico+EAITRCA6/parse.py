@@ -6,12 +6,14 @@ import bz2
 import statistics
 
 parser = argparse.ArgumentParser(description="Parser of High Resolution binary (not MIDI) files")
-parser.add_argument("filename", help="Load <FILENAME> for plotting, analysis or dumping in a text file")
+parser.add_argument("filename", nargs="+",
+                    help="Load <FILENAME> for plotting, analysis or dumping in a text file (more than one only with --spectrum)")
 
 action = parser.add_mutually_exclusive_group(required=True)
 action.add_argument("-d", "--dump", help="Dump the content of FILENAME on the terminal", action="store_true")
 action.add_argument("-p", "--plot", help="Plot the content of FILENAME with matplotlib", action="store_true")
 action.add_argument("-m", "--midi-plot", help="Pretend to a RPi Pico: plot MIDI velocities", action="store_true")
+action.add_argument("-f", "--spectrum", help="Plot Welch power spectral density of each channel of each FILENAME", action="store_true")
 
 action = parser.add_mutually_exclusive_group()
 action.add_argument("-c", "--comparator", help="Compute MIDI velocities with comparator approach only", action="store_true")
@@ -19,14 +21,45 @@ action.add_argument("-s", "--savgol", help="Compute MIDI velocities with Sav-Gol
 action.add_argument("-b", "--both", help="MIDI vel with both comparator & Sav-Gol (succint)", action="store_true")
 action.add_argument("-a", "--all", help="MIDI vel with both comparator & Sav-Gol (complete)", action="store_true")
 
-file_format = parser.add_mutually_exclusive_group(required=True)
+file_format = parser.add_mutually_exclusive_group()
 file_format.add_argument("-12", help="Force two 12-bit samples, 1-ADC channel per timestamp",
                          dest="bits_12", action="store_true")
 file_format.add_argument("-8", help="Force three 8-bit samples, 3-ADC channels per timestamp",
                          dest="bits_8", action="store_true")
+
+spectrum = parser.add_argument_group("spectrum options")
+spectrum.add_argument("--segment", help="Samples per Welch segment (default 65536)", type=int, default=65536)
+spectrum.add_argument("--chunk", help="Timestamps read at a time, to bound memory (default 1048576)", type=int, default=1048576)
+spectrum.add_argument("--peaks", help="Number of peaks to report for each channel (default 5)", type=int, default=5)
+spectrum.add_argument("--prominence", help="Minimum prominence of a peak, in decades of PSD (default 0.2)", type=float, default=0.2)
 args = parser.parse_args()
 
 
+def file_bits(filename):
+    if args.bits_12:
+        return 12
+    if args.bits_8:
+        return 8
+    if ".12bit." in filename:
+        return 12
+    if ".8bit." in filename:
+        return 8
+    parser.error("cannot guess the format of " + filename + ", use -12 or -8")
+
+
+if args.segment < 2:
+    parser.error("--segment must be at least 2")
+if args.chunk < 1:
+    parser.error("--chunk must be positive")
+
+if not args.spectrum:
+    if len(args.filename) > 1:
+        parser.error("only --spectrum accepts more than one FILENAME")
+    args.filename = args.filename[0]
+    args.bits_12 = file_bits(args.filename) == 12
+    args.bits_8 = not args.bits_12
+
+
 if not any((args.comparator, args.savgol, args.both, args.all)):
     args.both = True
 
@@ -205,11 +238,129 @@ def parse_ADC_data(d, t, r):
     return midi_data, time_data
 
 
-if args.plot or args.midi_plot:
+def read_chunks(filename, bits, chunk):
+    # same decoding as below, but vectorized and a chunk at a time, so that multi-hours files fit in memory
+    with bz2.open(filename, mode='rb') as file:
+        increment = 0
+        old_time = None
+        while True:
+            b = file.read(4 * chunk)
+            if len(b) < 4:
+                break
+            b = np.frombuffer(b[:len(b) - len(b) % 4], dtype=np.uint8).reshape(-1, 4).astype(np.int64)
+            raw_time = b[:, 3]
+            if old_time is None:
+                old_time = raw_time[0]
+            wrapped = np.diff(raw_time, prepend=old_time) < 0
+            time = raw_time + increment + 256 * np.cumsum(wrapped)
+            increment = time[-1] - raw_time[-1]
+            old_time = raw_time[-1]
+            if bits == 12:
+                d2 = b[:, 0] + ((b[:, 1] & 0x0F) << 8)
+                d1 = (b[:, 2] << 4) + ((b[:, 1] & 0xF0) >> 4)
+                yield time, np.stack((d1, d2), axis=1).astype(np.float64)
+            else:
+                yield time, b[:, :3].astype(np.float64)
+
+
+class welch():
+    def __init__(self, n_channels, segment):
+        self.segment = segment
+        self.step = segment // 2                                     # 50% overlap
+        self.window = np.hanning(segment + 1)[:-1]                  # periodic, as scipy.signal.welch
+        self.buffer = np.empty((0, n_channels))
+        self.power = np.zeros((n_channels, segment // 2 + 1))
+        self.n_segments = 0
+
+    def add(self, samples):
+        self.buffer = np.concatenate((self.buffer, samples))
+        n = (len(self.buffer) - self.segment) // self.step + 1
+        if n <= 0:
+            return
+        segments = np.lib.stride_tricks.sliding_window_view(self.buffer, self.segment, axis=0)[:n * self.step:self.step]
+        segments = segments - segments.mean(axis=-1, keepdims=True)             # detrend
+        self.power += (np.abs(np.fft.rfft(segments * self.window, axis=-1)) ** 2).sum(axis=0)
+        self.n_segments += n
+        self.buffer = self.buffer[n * self.step:]
+
+    def psd(self, rate):
+        density = self.power / (self.n_segments * rate * (self.window ** 2).sum())
+        density[:, 1:(self.segment + 1) // 2] *= 2                              # one-sided
+        return np.fft.rfftfreq(self.segment, 1 / rate), density
+
+
+def file_spectrum(filename, bits):
+    w = None
+    rate = None
+    last_time = None
+    last_data = None
+    for (time, data) in read_chunks(filename, bits, args.chunk):
+        if bits == 12:                                  # first sample of each pair is halfway, as in interpolate_time()
+            previous = np.concatenate(([time[0] if last_time is None else last_time[-1]], time[:-1]))
+            time, data = np.stack(((time + previous) / 2, time), axis=1).reshape(-1), data.reshape(-1, 1)
+        if w is None:
+            w = welch(data.shape[1], args.segment)
+            steps = np.diff(time)
+            if not np.any(steps > 0):
+                print("Warning, cannot find the sampling rate of", filename)
+                return None, None, None
+            period = np.median(steps[steps > 0])
+            rate = 1000000 / period                     # Hz, time is in us
+            grid_time = time[0]
+        if last_time is not None:                       # to interpolate across chunks
+            time = np.concatenate((last_time[-1:], time))
+            data = np.concatenate((last_data[-1:], data))
+        grid = np.arange(grid_time, time[-1], period)
+        if len(grid) > 0:
+            grid_time = grid[-1] + period
+            w.add(np.stack([np.interp(grid, time, data[:, c]) for c in range(data.shape[1])], axis=1))
+        last_time = time
+        last_data = data
+
+    if w is None or w.n_segments == 0:
+        print("Warning, not enough data in", filename, "for a segment of", args.segment)
+        return None, None, None
+    freq, density = w.psd(rate)
+    return rate, freq, density
+
+
+def print_peaks(freq, density, label):
+    from scipy.signal import find_peaks
+    log_density = np.log10(np.maximum(density, np.finfo(np.float64).tiny))   # a constant channel has 0 PSD
+    peaks, properties = find_peaks(log_density[1:], prominence=args.prominence)        # skipping DC
+    best = peaks[np.argsort(properties["prominences"])[::-1][:args.peaks]] + 1
+    print(label, "peaks:", end="")
+    for p in sorted(best):
+        print("\t{:.1f} Hz ({:.1f} dB)".format(freq[p], 10 * log_density[p]), end="")
+    print()
+
+
+def plot_spectra():
+    fig, ax = plt.subplots()
+    for filename in args.filename:
+        bits = file_bits(filename)
+        rate, freq, density = file_spectrum(filename, bits)
+        if rate is None:
+            continue
+        print(filename, "resampled at {:.1f} Hz".format(rate))
+        for (c, d) in enumerate(density):
+            label = filename + (" ADC" if bits == 12 else " ADC" + str(c + 1))
+            print_peaks(freq, d, label)
+            ax.semilogy(freq[1:], d[1:], label=label)
+    ax.set_xlabel('frequency (Hz)')
+    ax.set_ylabel('PSD (ADC units$^2$/Hz)')
+    ax.legend()
+    plt.show()
+
+
+if args.plot or args.midi_plot or args.spectrum:
     import matplotlib.pyplot as plt      # importing here to allow saving without GTK
     from scipy.signal import savgol_coeffs
+    import numpy as np
 
-if args.bits_12:
+if args.spectrum:
+    plot_spectra()
+elif args.bits_12:
     data = []
     time = []
 